@@ -6,16 +6,32 @@ import ssl
 
 import nltk
 
+# NLTK packages used by the backend, keyed by their path in the NLTK data
+# directory.
+NLTK_PACKAGES = {
+    "sentiment/vader_lexicon": "vader_lexicon",
+    "corpora/wordnet": "wordnet",
+}
+
 
 def download():
+    """
+    Download the NLTK packages that are not installed yet.
+
+    Packages that are already present are found locally, so repeated calls
+    do not go to the network.
+    """
     try:
         _create_unverified_https_context = ssl._create_unverified_context
     except AttributeError:
         pass
     else:
         ssl._create_default_https_context = _create_unverified_https_context
-    nltk.download("vader_lexicon")
-    nltk.download("wordnet")
+    for path, package in NLTK_PACKAGES.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            nltk.download(package, quiet=True)
 
 
 if __name__ == "__main__":
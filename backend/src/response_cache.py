@@ -0,0 +1,97 @@
+"""
+Optional on-disk cache of YouTube API responses.
+
+Repeated queries for the same term would otherwise spend the same quota
+again. The cache is disabled unless YOUTUBE_CACHE_DIR is set.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import orjson
+
+CACHE_DIR = os.environ.get("YOUTUBE_CACHE_DIR")  # Disabled when unset
+CACHE_TTL = int(os.environ.get("YOUTUBE_CACHE_TTL", 24 * 60 * 60))  # Seconds
+
+
+def cache_path(request: Any) -> Optional[str]:
+    """
+    Return the file that caches the response to a request.
+
+    Parameters
+    ----------
+    request : HttpRequest
+        The API request. Its method, uri and body identify the response.
+
+    Returns
+    -------
+    str or None
+        The path of the cache file, or None when caching is disabled.
+    """
+    if not CACHE_DIR:
+        return None
+    key = f"{request.method} {request.uri} {request.body or ''}"
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{digest}.json")
+
+
+def load_response(request: Any) -> Optional[Dict[str, Any]]:
+    """
+    Load the cached response to a request.
+
+    Parameters
+    ----------
+    request : HttpRequest
+        The API request.
+
+    Returns
+    -------
+    dict or None
+        The response, or None when it is not cached or older than CACHE_TTL.
+    """
+    path = cache_path(request)
+    if path is None:
+        return None
+    try:
+        if time.time() - os.path.getmtime(path) > CACHE_TTL:
+            return None
+        with open(path, "rb") as cache_file:
+            return orjson.loads(cache_file.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+
+def save_response(request: Any, response: Dict[str, Any]) -> None:
+    """
+    Cache the response to a request.
+
+    Caching is best-effort: a response that cannot be written, for example
+    because the disk is full, is simply not cached.
+
+    Parameters
+    ----------
+    request : HttpRequest
+        The API request.
+    response : dict
+        The response to cache.
+    """
+    path = cache_path(request)
+    if path is None:
+        return
+
+    # Write to a temporary file first so that concurrent readers never see a
+    # partially written response.
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, "wb") as cache_file:
+            cache_file.write(orjson.dumps(response))
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
@@ -12,39 +12,125 @@ The output from the endpoint will be ranked by those criteria.
 """
 
 import argparse
+import functools
+import itertools
+import json
+import multiprocessing
 import os
 import random
 import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from enum import Enum
-from typing import Any, Dict, Generator, List, Tuple
+from types import MappingProxyType
+from typing import Any, Dict, FrozenSet, List, Tuple
 
-import bonobo
 import googleapiclient.discovery
+import googleapiclient.http
+import numpy as np
 import pandas as pd
-from bonobo.config import use
+import response_cache  # pylint: disable=import-error
 from download import download  # pylint: disable=import-error
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fuzzywuzzy import fuzz
+from fastapi.responses import ORJSONResponse
 from nltk.sentiment import SentimentIntensityAnalyzer
 from pydantic import BaseModel
+from rapidfuzz import fuzz, process
 
 # from tabulate import tabulate
 
 
-class ChainType(Enum):
+class SentimentMethod(Enum):
     """
-    Enumeration of graph chain types.
+    Enumeration of comment sentiment scorers.
     """
 
-    CHANNEL_DATA = (1,)
-    COMMENT_THREAD_DATA = 2
+    VADER = "vader"  # VADER's rule based positive score
+    LEXICON = "lexicon"  # Fraction of words that are positive in the lexicon
 
 
 # Global data
-KV_STORE: Dict[ChainType, pd.DataFrame] = (
-    {}
-)  # Key-Value storage for the transform results
+MAX_WORKERS = 16  # Maximum number of concurrent YouTube API requests
+BATCH_SIZE = 50  # Maximum number of requests bundled into one HTTP request
+THREAD_DATA = threading.local()  # Per-thread HTTP connection for API workers
+USER_AGENT = "youtube-scraper (gzip)"  # "(gzip)" asks Google to compress
+EMPTY: "MappingProxyType[str, Any]" = MappingProxyType({})  # Default for .get()
+WORD_PATTERN = re.compile(r"\w+")  # Splits text into words
+REPEAT_PATTERN = re.compile(r"(\W)\1{4,}")  # Runs of 5+ identical symbols
+MAX_COMMENT_LENGTH = 2000  # Characters of a comment passed to VADER
+NUM_RETRIES = 3  # Retries with backoff for rate limited or failed requests
+RETRY_REASONS = {
+    "rateLimitExceeded",
+    "userRateLimitExceeded",
+}  # Reasons a 403 response is worth retrying
+# The rate limiter only smooths bursts of API calls. It does not track or
+# bound the daily quota of the API key, and the retries that
+# request.execute(num_retries=...) makes on its own take no extra tokens.
+QUOTA_RATE = 100  # Quota units per second the API calls may use
+QUOTA_BURST = 1000  # Quota units the API calls may use at once
+QUOTA_COSTS = {
+    "search": 100,
+    "channels": 1,
+    "commentThreads": 1,
+}  # Quota units used by one request to each endpoint
+SENTIMENT_WORKERS = min(os.cpu_count() or 1, 4)  # Processes to score comments
+SENTIMENT_POOL_THRESHOLD = 2000  # Distinct comments before using processes
+SENTIMENT_SCORES: Dict[str, float] = {}  # Scores computed by the processes
+SENTIMENT_SCORES_SIZE = 131072  # Maximum number of scores kept
+SENTIMENT_SCORES_LOCK = threading.Lock()  # Guards SENTIMENT_SCORES
+SENTIMENT_METHOD = SentimentMethod(
+    os.environ.get("SENTIMENT_METHOD", SentimentMethod.VADER.value)
+)  # Scorer used for comment sentiment
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket that paces API calls by their quota cost.
+
+    Parameters
+    ----------
+    rate : float
+        The number of tokens added per second.
+    capacity : float
+        The maximum number of tokens the bucket holds.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> None:
+        """
+        Take tokens from the bucket, sleeping until they are available.
+
+        The tokens are reserved before sleeping, so callers that arrive while
+        the bucket is empty queue up behind each other.
+
+        Parameters
+        ----------
+        tokens : float
+            The number of tokens to take.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+RATE_LIMITER = RateLimiter(QUOTA_RATE, QUOTA_BURST)  # Shared by API workers
 
 
 class Query(BaseModel):
@@ -111,7 +197,29 @@ class Row(BaseModel):
 
 origins = ["*"]
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Prepare the server before it starts handling queries, and clean up after
+    it stops.
+
+    Parameters
+    ----------
+    app : FastAPI
+        The application being started.
+    """
+    # Download NLTK plug-ins once rather than on every query.
+    download()
+    yield
+
+    # Stop the sentiment scoring processes if a query started them.
+    if sentiment_pool.cache_info().currsize:
+        sentiment_pool().shutdown()
+        sentiment_pool.cache_clear()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -122,8 +230,8 @@ app.add_middleware(
 )
 
 
-@app.post("/query/")
-def do_query(query: Query) -> List[Row]:
+@app.post("/query/", response_model=List[Row], response_class=ORJSONResponse)
+async def do_query(query: Query) -> ORJSONResponse:
     """
     This is the main api entry point that the frontend communicates through.
 
@@ -135,25 +243,25 @@ def do_query(query: Query) -> List[Row]:
 
     Returns
     -------
-    list[Row]
-        A list of JSON objects that includes information about interesting
+    ORJSONResponse
+        A JSON list of Row objects that includes information about interesting
         channels you might want to subscribe to.
     """
 
     MAX_RESULTS = 20
-    df = main(query.query_string).head(MAX_RESULTS)
-    json_data = df.to_dict(orient="records")  # 'records' is a common format
-    print("=================")
-    print(json_data)
-    print("=================")
 
-    return [Row(**row_dict) for row_dict in json_data]
+    # The pipeline blocks on the YouTube API and on CPU bound scoring, so run
+    # it on a worker thread and keep the event loop free for other requests.
+    df = await run_in_threadpool(main, query.query_string)
+    df = df.head(MAX_RESULTS)
+    records = df.to_dict(orient="records")  # 'records' is a common format
+
+    # Serialize the records directly with orjson rather than building Row
+    # models for FastAPI to encode again with the standard json module.
+    return ORJSONResponse(records)
 
 
-@use("query")
-def extract_search_data(
-    query: str,
-) -> Generator[List[Tuple[str, str]], None, None]:
+def extract_search_data(query: str) -> List[Tuple[str, str]]:
     """
     Search for videos that match a query string.
 
@@ -162,9 +270,9 @@ def extract_search_data(
     query : str
         The query string used in the "q" parameter.
 
-    Yields
-    ------
-    Generator[list[tuple[str, str]], None, None]
+    Returns
+    -------
+    list[tuple[str, str]]
         A list of tuple pairs (video_id, channel_id)
     """
     MAX_RESULTS_PER_PAGE = 50
@@ -192,7 +300,7 @@ def extract_search_data(
 
         try:
             request = youtube.search().list(**params)  # type: ignore
-            response = request.execute()
+            response = execute_request(request, "search")
             response_list.append(response)
             page_token = response.get("nextPageToken")
         except googleapiclient.errors.HttpError as e:
@@ -205,26 +313,187 @@ def extract_search_data(
     search_data = []
     for response in response_list:
         for item in response.get("items", []):
-            video_id = item.get("id", {}).get("videoId")
-            channel_id = item.get("snippet", {}).get("channelId")
+            video_id = item.get("id", EMPTY).get("videoId")
+            channel_id = item.get("snippet", EMPTY).get("channelId")
             search_data.append((video_id, channel_id))
-    yield search_data
+    return search_data
 
 
-def extract_comment_thread_data(
+def index_search_data(
     search_data: List[Tuple[str, str]]
-) -> Generator[Dict[str, List[Any]], None, None]:
+) -> Dict[str, List[str]]:
     """
-    Extract comments for all of the videos.
+    Group the search results by channel in a single pass, so that the channel
+    and comment thread extractors do not each walk the search results.
 
     Parameters
     ----------
     search_data : list[tuple[str, str]]
         A list of tuple pairs (video_id, channel_id)
 
-    Yields
-    ------
-    Generator[dict[str, list[Any]], None, None]
+    Returns
+    -------
+    dict[str, list[str]]
+        The video ids keyed by channel id, in the order the channels were
+        first found.
+    """
+    videos: Dict[str, List[str]] = {}
+    for video_id, channel_id in search_data:
+        videos.setdefault(channel_id, []).append(video_id)
+    return videos
+
+
+def sample_videos(videos: Dict[str, List[str]], n: int) -> List[str]:
+    """
+    Pick up to n random videos from every channel.
+
+    Parameters
+    ----------
+    videos : dict[str, list[str]]
+        The video ids keyed by channel id.
+    n : int
+        The maximum number of videos to pick per channel.
+
+    Returns
+    -------
+    list[str]
+        The picked video ids, grouped by channel in the order of videos.
+    """
+    video_ids = [video_id for ids in videos.values() for video_id in ids]
+    counts = np.array([len(ids) for ids in videos.values()], dtype=np.int64)
+    channel_index = np.repeat(np.arange(len(counts)), counts)
+
+    # Shuffle the videos within each channel with one sort on random keys,
+    # then keep the first n of every channel.
+    rng = np.random.default_rng()
+    order = np.lexsort((rng.random(len(video_ids)), channel_index))
+    starts = np.cumsum(counts) - counts
+    position = np.arange(len(video_ids)) - starts[channel_index]
+    return [video_ids[i] for i in order[position < n]]
+
+
+def init_worker():
+    """
+    Give an API worker thread its own HTTP connection.
+
+    httplib2 connections are not thread-safe, so requests executed from a
+    thread pool must not share the connection of the client that built them.
+
+    Single API requests already ask for gzip, but batch requests do not carry
+    the "(gzip)" user agent Google requires before it compresses a response,
+    so it is set on the connection itself.
+    """
+    THREAD_DATA.http = googleapiclient.http.set_user_agent(
+        googleapiclient.http.build_http(), USER_AGENT
+    )
+
+
+def execute_request(request: Any, endpoint: str, **kwargs) -> Dict[str, Any]:
+    """
+    Execute a single API request, reusing a cached response when there is
+    one.
+
+    Parameters
+    ----------
+    request : HttpRequest
+        The request to execute.
+    endpoint : str
+        The name of the endpoint, used to look up the quota cost.
+    **kwargs
+        Passed to request.execute.
+
+    Returns
+    -------
+    dict[str, Any]
+        The JSON response.
+    """
+    response = response_cache.load_response(request)
+    if response is None:
+        RATE_LIMITER.acquire(QUOTA_COSTS[endpoint])
+        response = request.execute(num_retries=NUM_RETRIES, **kwargs)
+        response_cache.save_response(request, response)
+    return response
+
+
+def is_retryable(exception: Exception) -> bool:
+    """
+    Decide whether a failed API request is worth retrying.
+
+    The same responses are retried as for single requests executed with
+    num_retries: server errors, 429s and 403s caused by rate limiting.
+
+    Parameters
+    ----------
+    exception : Exception
+        The exception the request failed with.
+
+    Returns
+    -------
+    bool
+        True if the request may succeed when it is sent again.
+    """
+    if not isinstance(exception, googleapiclient.errors.HttpError):
+        return False
+    status = exception.resp.status
+    if status == 429 or status >= 500:
+        return True
+    if status != 403:
+        return False
+
+    # Read the reason the way the client does: from the "errors" list if
+    # there is one, otherwise from the status or message of the error.
+    try:
+        error = json.loads(exception.content)["error"]
+        if "errors" in error:
+            reasons = {detail.get("reason") for detail in error["errors"]}
+        else:
+            reasons = {error.get("status"), error.get("message")}
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return False
+    return not reasons.isdisjoint(RETRY_REASONS)
+
+
+def execute_batch(batch: Any, cost: int) -> bool:
+    """
+    Execute a batch of requests on the calling worker's connection.
+
+    Parameters
+    ----------
+    batch : BatchHttpRequest
+        The batch to execute. Responses are delivered through the batch
+        callback.
+    cost : int
+        The quota units used by the requests in the batch.
+
+    Returns
+    -------
+    bool
+        True if the whole batch failed with an error worth retrying.
+    """
+    RATE_LIMITER.acquire(cost)
+    try:
+        batch.execute(http=THREAD_DATA.http)
+    except googleapiclient.errors.HttpError as e:
+        if is_retryable(e):
+            return True
+        print(f"Error: unexpected exception e={e}")
+    return False
+
+
+def extract_comment_thread_data(
+    videos: Dict[str, List[str]]
+) -> Dict[str, List[Any]]:
+    """
+    Extract comments for all of the videos.
+
+    Parameters
+    ----------
+    videos : dict[str, list[str]]
+        The video ids found by the search, keyed by channel id.
+
+    Returns
+    -------
+    dict[str, list[Any]]
         Returs a dictionary with an "items" key whose value is the JSON data
         of all of the responses.
     """
@@ -237,46 +506,90 @@ def extract_comment_thread_data(
 
     data: Dict[str, List[Any]] = {}
     data["items"] = []
-    videos: Dict[str, List[Any]] = {}
     n = 2
+    max_comment_threads = 20
+
+    # The top level comments are enough for a channel's average sentiment, so
+    # leave the replies out of the responses, and ask for the most relevant
+    # threads rather than the newest.
+    comment_requests = [
+        youtube.commentThreads().list(  # type: ignore
+            part="snippet",
+            videoId=video_id,
+            maxResults=max_comment_threads,
+            order="relevance",
+        )
+        for video_id in sample_videos(videos, n)
+    ]
 
-    # Create dictionary
-    for list_item in search_data:
-        video_id = list_item[0]
-        channel_id = list_item[1]
-        if channel_id not in videos:
-            videos[channel_id] = []
-        videos[channel_id].append(video_id)
-
-    for channel_id, video_list in videos.items():
-        if len(video_list) > 2:
-            video_list = random.sample(video_list, n)
-        for video_id in video_list:
-            try:
-                request = youtube.commentThreads().list(  # type: ignore
-                    part="id, replies, snippet", videoId=video_id
+    responses = [
+        response_cache.load_response(request) for request in comment_requests
+    ]
+    pending = [j for j, response in enumerate(responses) if response is None]
+    retry: List[int] = []
+
+    def store_response(request_id: str, response: Dict[str, Any], exception):
+        j = int(request_id)
+        if exception is None:
+            responses[j] = response
+            response_cache.save_response(comment_requests[j], response)
+        elif is_retryable(exception):
+            retry.append(j)
+        # Videos with comments disabled fail individually; skip them.
+
+    with ThreadPoolExecutor(
+        max_workers=MAX_WORKERS, initializer=init_worker
+    ) as executor:
+        for attempt in range(NUM_RETRIES + 1):
+            if attempt:
+                # Back off the same way the client does for single requests.
+                time.sleep(random.random() * pow(2, attempt))
+
+            # Bundle the requests that are not cached so that each round trip
+            # carries up to BATCH_SIZE of them, then overlap the round trips
+            # of the batches.
+            chunks = []
+            batches = []
+            costs = []
+            for i in range(0, len(pending), BATCH_SIZE):
+                batch = youtube.new_batch_http_request(  # type: ignore
+                    callback=store_response
                 )
-                response = request.execute()
-                data["items"].append(response)
-            except googleapiclient.errors.HttpError:
-                pass
-    yield data
+                chunk = pending[i : i + BATCH_SIZE]  # noqa: E203
+                for j in chunk:
+                    batch.add(comment_requests[j], request_id=str(j))
+                chunks.append(chunk)
+                batches.append(batch)
+                costs.append(QUOTA_COSTS["commentThreads"] * len(chunk))
+            for chunk, failed in zip(
+                chunks, executor.map(execute_batch, batches, costs)
+            ):
+                if failed:
+                    retry.extend(chunk)
+
+            # Send the requests that were rate limited or hit a server error,
+            # alone or as a whole batch, again in new batches.
+            if not retry:
+                break
+            pending = sorted(retry)
+            retry.clear()
 
+    data["items"] = [response for response in responses if response is not None]
+    return data
 
-def extract_channel_data(
-    search_data: List[Tuple[str, str]]
-) -> Generator[Dict[str, List[Any]], None, None]:
+
+def extract_channel_data(videos: Dict[str, List[str]]) -> Dict[str, List[Any]]:
     """
     Extract channel data for all of the videos.
 
     Parameters
     ----------
-    search_data : list[tuple[str, str]]
-        A list of tuple pairs (video_id, channel_id)
+    videos : dict[str, list[str]]
+        The video ids found by the search, keyed by channel id.
 
-    Yields
-    ------
-    Generator[dict[str, list[Any]], None, None]
+    Returns
+    -------
+    dict[str, list[Any]]
         Returns a dictionary with an "items" key whose value is the JSON data
         of all of the responses.
     """
@@ -290,49 +603,90 @@ def extract_channel_data(
 
     data: dict = {}
     data["items"] = []
-    channel_ids = set()
-    for list_item in search_data:
-        channel_id = list_item[1]
-        channel_ids.add(channel_id)
-
-    channel_id_list = list(channel_ids)
-    chunk_size = 10
+    channel_id_list = list(videos)
+    chunk_size = 50  # Most ids the channels endpoint accepts per call
     sublists = [
         channel_id_list[i : i + chunk_size]  # noqa: E203
         for i in range(0, len(channel_id_list), chunk_size)
     ]
-    for sublist in sublists:
-        channel_ids_str = ",".join(list(sublist))
-        params = {
-            "part": "id, statistics, snippet",
-            "id": channel_ids_str,
-            "maxResults": 50,
-        }
-        while True:
-            page_token = None
-            try:
-                request = youtube.channels().list(**params)  # type: ignore
-                response = request.execute()
-                data["items"].extend(response.get("items", []))
-                page_token = response.get("nextPageToken")
-            except googleapiclient.errors.HttpError as e:
-                print(f"Error: unexpected exception e={e}")
-
-            if page_token:
-                params = {
-                    "part": "id, statistics, snippet",
-                    "id": channel_ids_str,
-                    "pageToken": page_token,
-                }
-            else:
-                break
-    yield data
+
+    def fetch_channels(channel_ids_str: str) -> List[Any]:
+        # A list of ids is answered in a single page, so there is no
+        # pageToken to follow.
+        request = youtube.channels().list(  # type: ignore
+            part="id, statistics, snippet",
+            id=channel_ids_str,
+            maxResults=chunk_size,
+        )
+        try:
+            response = execute_request(
+                request, "channels", http=THREAD_DATA.http
+            )
+        except googleapiclient.errors.HttpError as e:
+            print(f"Error: unexpected exception e={e}")
+            return []
+        return response.get("items", [])
+
+    # Each chunk of ids is an independent request, so overlap their network
+    # round trips.
+    with ThreadPoolExecutor(
+        max_workers=MAX_WORKERS, initializer=init_worker
+    ) as executor:
+        for items in executor.map(
+            fetch_channels, [",".join(sublist) for sublist in sublists]
+        ):
+            data["items"].extend(items)
+    return data
+
+
+@functools.lru_cache(maxsize=1)
+def sentiment_analyzer() -> SentimentIntensityAnalyzer:
+    """
+    Return the shared VADER sentiment analyzer.
+
+    The analyzer loads the VADER lexicon when it is constructed, so it is
+    created on first use (after the NLTK data has been downloaded) and then
+    reused for every comment.
+
+    Returns
+    -------
+    SentimentIntensityAnalyzer
+        The process-wide sentiment analyzer.
+    """
+    return SentimentIntensityAnalyzer()
 
 
+@functools.lru_cache(maxsize=1)
+def sentiment_pool() -> ProcessPoolExecutor:
+    """
+    Return the shared pool of sentiment scoring processes.
+
+    VADER is pure Python, so large batches are scored across processes
+    rather than threads. Each worker builds its own analyzer when it starts.
+
+    The workers are spawned rather than forked, because the server's other
+    threads may hold locks at the time of a fork.
+
+    Returns
+    -------
+    ProcessPoolExecutor
+        The process-wide scoring pool.
+    """
+    return ProcessPoolExecutor(
+        max_workers=SENTIMENT_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=sentiment_analyzer,
+    )
+
+
+@functools.lru_cache(maxsize=131072)
 def perform_sentiment_analysis(text: str) -> float:
     """
     Perform a sentiment analysis on each comment.
 
+    Scores are cached by text because comment threads repeat many short
+    comments ("First", "Nice video!", emoji-only replies).
+
     Parameters
     ----------
     text : str
@@ -344,60 +698,175 @@ def perform_sentiment_analysis(text: str) -> float:
         A value between 0.0 and 1.0 with 0.0 being no positive sentiment and
         1.0 being 100% positive sentiment.
     """
-    # Initialize VADER sentiment analyzer
-    sid = SentimentIntensityAnalyzer()
+    # VADER slows down badly on long runs of repeated emoji and punctuation.
+    # It stops amplifying after four "!" or "?" anyway, so shortening longer
+    # runs to four bounds the cost while barely changing the score.
+    text = REPEAT_PATTERN.sub(r"\1\1\1\1", text)[:MAX_COMMENT_LENGTH]
 
     # Perform sentiment analysis
-    sentiment_score = sid.polarity_scores(text)["pos"]
+    sentiment_score = sentiment_analyzer().polarity_scores(text)["pos"]
     return sentiment_score
 
 
-def transform_comment_thread_data(
-    comment_thread_data: Dict,
-) -> Generator[Tuple[ChainType, pd.DataFrame], None, None]:
+def perform_batch_sentiment_analysis(texts: List[str]) -> List[float]:
     """
-    Transform the comment_thread_data into a useable dataframe.
+    Perform a sentiment analysis on a batch of comments.
+
     Parameters
+    ----------
+    texts : list[str]
+       The strings to be analyzed.
+
+    Returns
+    -------
+    list[float]
+        One value between 0.0 and 1.0 per string, in the same order as
+        texts.
+    """
+    if SENTIMENT_METHOD is SentimentMethod.LEXICON:
+        return perform_lexicon_sentiment_analysis(texts)
+
+    unique_texts = list(dict.fromkeys(texts))
+    if SENTIMENT_WORKERS < 2 or len(unique_texts) < SENTIMENT_POOL_THRESHOLD:
+        return [perform_sentiment_analysis(text) for text in texts]
+
+    # Scores computed by the worker processes never reach the cache of
+    # perform_sentiment_analysis in this process, so they are kept in
+    # SENTIMENT_SCORES and only the comments missing from it are scored.
+    with SENTIMENT_SCORES_LOCK:
+        scores = {
+            text: SENTIMENT_SCORES[text]
+            for text in unique_texts
+            if text in SENTIMENT_SCORES
+        }
+    missing = [text for text in unique_texts if text not in scores]
+    if len(missing) < SENTIMENT_POOL_THRESHOLD:
+        new_scores = [perform_sentiment_analysis(text) for text in missing]
+    else:
+        # Score each new comment once, spread over the worker processes.
+        new_scores = list(
+            sentiment_pool().map(
+                perform_sentiment_analysis, missing, chunksize=64
+            )
+        )
+    scores.update(zip(missing, new_scores))
+
+    with SENTIMENT_SCORES_LOCK:
+        SENTIMENT_SCORES.update(zip(missing, new_scores))
+        # Forget the oldest scores once there are too many.
+        excess = max(len(SENTIMENT_SCORES) - SENTIMENT_SCORES_SIZE, 0)
+        for text in list(itertools.islice(SENTIMENT_SCORES, excess)):
+            del SENTIMENT_SCORES[text]
+    return [scores[text] for text in texts]
+
+
+@functools.lru_cache(maxsize=1)
+def positive_words() -> FrozenSet[str]:
+    """
+    Return the words with a positive valence in the VADER lexicon.
+
+    Returns
+    -------
+    frozenset[str]
+        The positive words.
+    """
+    lexicon = sentiment_analyzer().lexicon
+    return frozenset(word for word, valence in lexicon.items() if valence > 0)
+
+
+def perform_lexicon_sentiment_analysis(texts: List[str]) -> List[float]:
+    """
+    Perform a coarse dictionary based sentiment analysis on a batch of
+    comments.
+
+    Each comment is scored as the fraction of its words that are positive in
+    the lexicon. This skips VADER's rules (negation, intensifiers, etc.),
+    which is adequate for the per-channel average and much cheaper.
+
+    Parameters
+    ----------
+    texts : list[str]
+       The strings to be analyzed.
+
+    Returns
+    -------
+    list[float]
+        One value between 0.0 and 1.0 per string, in the same order as
+        texts.
+    """
+    positive = positive_words()
+
+    # Flatten the words of every comment into one array, then count the
+    # words and positive words of each comment in a single vectorized pass.
+    words: List[str] = []
+    n_words = np.empty(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        text_words = WORD_PATTERN.findall(text.lower())
+        words.extend(text_words)
+        n_words[i] = len(text_words)
+    is_positive = np.fromiter(
+        (word in positive for word in words), dtype=np.float64, count=len(words)
+    )
+    text_index = np.repeat(np.arange(len(texts)), n_words)
+    n_positive = np.bincount(
+        text_index, weights=is_positive, minlength=len(texts)
+    )
+    return (n_positive / np.maximum(n_words, 1)).tolist()
+
+
+def transform_comment_thread_data(comment_thread_data: Dict) -> pd.DataFrame:
+    """
+    Transform the comment_thread_data into a useable dataframe.
 
     Parameters
     ----------
     comment_thread_data : dict
         A dictionary containing the comment thread data.
 
-    Yields
-    ------
-    Generator[tuple[ChainType, pd.DataFrame], None, None]
-        A tuple pair (key, df) that contains the type of data and a
-        useable dataframe.
+    Returns
+    -------
+    pd.DataFrame
+        The average comment score of each channel.
     """
 
     print("in transform_comment_thread_data")
-    data = []
+    channel_ids: List[str] = []
+    comment_texts: List[str] = []
     for item in comment_thread_data.get("items", []):
         for comment_item in item.get("items", []):
-            channel_id = comment_item.get("snippet", {}).get("channelId", "")
-            top_level = (
-                comment_item.get("snippet", {})
-                .get("topLevelComment", {})
-                .get("snippet", {})
+            snippet = comment_item.get("snippet", EMPTY)
+            channel_id = snippet.get("channelId", "")
+            top_level = snippet.get("topLevelComment", EMPTY).get(
+                "snippet", EMPTY
             )
-            comment_text = top_level.get("textOriginal", "")
-            score = perform_sentiment_analysis(comment_text)
-            data.append((channel_id, score))
-            for reply in comment_item.get("replies", {}).get("comments", []):
-                comment_text = reply.get("snippet", {}).get("textOriginal", "")
-                score = perform_sentiment_analysis(comment_text)
-                data.append((channel_id, score))
-    df = pd.DataFrame(data, columns=["Channel_Id", "Score"])
-    grouped_data = df.groupby("Channel_Id")["Score"].mean()
-    result_df = grouped_data.reset_index()
-    yield (ChainType.COMMENT_THREAD_DATA, result_df)
-
-
-@use("query")
-def transform_channel_data(
-    channel_data: dict, query: str
-) -> Generator[Tuple[ChainType, pd.DataFrame], None, None]:
+            channel_ids.append(channel_id)
+            comment_texts.append(top_level.get("textOriginal", ""))
+            replies = comment_item.get("replies", EMPTY).get("comments", ())
+            for reply in replies:
+                channel_ids.append(channel_id)
+                comment_texts.append(
+                    reply.get("snippet", EMPTY).get("textOriginal", "")
+                )
+
+    # Score every comment in a single pass once they have all been collected,
+    # then average the scores of each channel straight from the arrays.
+    scores = np.array(
+        perform_batch_sentiment_analysis(comment_texts), dtype=np.float64
+    )
+    codes, channels = pd.factorize(
+        np.array(channel_ids, dtype=object), sort=True
+    )
+
+    # Comments without a channel id get code -1; leave them out, as the
+    # groupby this replaces did.
+    known = codes >= 0
+    codes, scores = codes[known], scores[known]
+    totals = np.bincount(codes, weights=scores, minlength=len(channels))
+    counts = np.bincount(codes, minlength=len(channels))
+    return pd.DataFrame({"Channel_Id": channels, "Score": totals / counts})
+
+
+def transform_channel_data(channel_data: dict, query: str) -> pd.DataFrame:
     """
     Transform the channel_data into a useable dataframe.
 
@@ -408,66 +877,66 @@ def transform_channel_data(
     query : str
         A query string that maps to the q value in the youtube api.
 
-    Yields
-    ------
-    Generator[tuple[str, pd.DataFrame], None, None]
-        A tuple pair of (key, df) signifying the thype of data and a
-        useable dataframe.
+    Returns
+    -------
+    pd.DataFrame
+        The statistics and query similarity of each channel.
     """
 
     print("in transform_channel_data")
-    data = []
-    for channel_item in channel_data.get("items", []):
-        channel_id = channel_item.get("id", "")
-        custom_url = channel_item.get("snippet", {}).get("customUrl", "")
-        url = f"https://www.youtube.com/{custom_url}"
-        title = channel_item.get("snippet", {}).get("title", "")
-        description = channel_item.get("snippet", {}).get("description", "")
-        sim_score = fuzzy_similarity(query, f"{title} : {description}")
-        video_count = channel_item.get("statistics", {}).get("videoCount", "")
-        subscriber_count = channel_item.get("statistics", {}).get(
-            "subscriberCount", ""
-        )
-        data.append(
-            (
-                channel_id,
-                title,
-                url,
-                description,
-                video_count,
-                subscriber_count,
-                sim_score,
-            )
-        )
+    channel_items = channel_data.get("items", [])
+    n = len(channel_items)
+    channel_ids = [""] * n
+    titles = [""] * n
+    urls = [""] * n
+    descriptions = [""] * n
+    video_counts = np.zeros(n, dtype=np.int64)
+    subscriber_counts = np.zeros(n, dtype=np.int64)
+    for i, channel_item in enumerate(channel_items):
+        channel_ids[i] = channel_item.get("id", "")
+        snippet = channel_item.get("snippet", EMPTY)
+        statistics = channel_item.get("statistics", EMPTY)
+        custom_url = snippet.get("customUrl", "")
+        urls[i] = f"https://www.youtube.com/{custom_url}"
+        title = snippet.get("title", "")
+        description = snippet.get("description", "")
+        titles[i] = title
+        descriptions[i] = description
+        # Counts arrive as strings and are absent when hidden by the channel.
+        video_count = statistics.get("videoCount")
+        subscriber_count = statistics.get("subscriberCount")
+        video_counts[i] = int(video_count or 0)
+        subscriber_counts[i] = int(subscriber_count or 0)
+    sim_scores = fuzzy_similarities(
+        query,
+        [f"{title} : {desc}" for title, desc in zip(titles, descriptions)],
+    )
     df = pd.DataFrame(
-        data,
-        columns=[
-            "Channel_Id",
-            "Title",
-            "Url",
-            "Description",
-            "Videos",
-            "Subscribers",
-            "Similarity",
-        ],
+        {
+            "Channel_Id": channel_ids,
+            "Title": titles,
+            "Url": urls,
+            "Description": descriptions,
+            "Videos": video_counts,
+            "Subscribers": subscriber_counts,
+            "Similarity": sim_scores,
+        }
     )
-    yield (ChainType.CHANNEL_DATA, df)
+    return df
 
 
-def transform_data() -> pd.DataFrame:
+def transform_data(
+    channel_df: pd.DataFrame, comment_thread_df: pd.DataFrame
+) -> pd.DataFrame:
     """
     Tranforms the extracted data into a single dataframe.
 
     Parameters
     ----------
-    query : str
-        q parameter for the search data
-
-    comment_thread_data : dict
-        JSON dictionary containing comment thread results.
-
-    channel_data : dict
-        JSON dictionary containing channel results.
+    channel_df : pd.DataFrame
+        The output of transform_channel_data.
+    comment_thread_df : pd.DataFrame
+        The output of transform_comment_thread_data.
 
     Returns
     -------
@@ -475,35 +944,22 @@ def transform_data() -> pd.DataFrame:
         A combined dataframe with elements from the channel and comment threads.
     """
 
-    comment_thread_df = KV_STORE[ChainType.COMMENT_THREAD_DATA]
-    channel_df = KV_STORE[ChainType.CHANNEL_DATA]
-
-    combined_df = pd.merge(
-        channel_df, comment_thread_df, how="left", on="Channel_Id"
-    )
-    combined_df["Videos"] = combined_df["Videos"].fillna(0)
-    combined_df["Subscribers"] = combined_df["Subscribers"].fillna(0)
-    combined_df["Score"] = combined_df["Score"].fillna(0.0)
-    combined_df["Similarity"] = combined_df["Similarity"].fillna(0.0)
-
-    combined_df["Videos_Rank"] = combined_df["Videos"].rank(
-        method="dense", ascending=False
-    )
-    combined_df["Subscribers_Rank"] = combined_df["Subscribers"].rank(
-        method="dense", ascending=False
-    )
-    combined_df["Score_Rank"] = combined_df["Score"].rank(
-        method="dense", ascending=False
-    )
-    combined_df["Similarity_Rank"] = combined_df["Similarity"].rank(
-        method="dense", ascending=False
-    )
-    combined_df["Average_Rank"] = (
-        combined_df["Videos_Rank"]
-        + combined_df["Subscribers_Rank"]
-        + combined_df["Score_Rank"]
-        + combined_df["Similarity_Rank"]
-    ) / 4.0
+    # Comment scores are unique per channel, so a lookup by id is a left join
+    # without the cost of a general merge.
+    combined_df = channel_df.copy()
+    scores = comment_thread_df.set_index("Channel_Id")["Score"]
+    combined_df["Score"] = combined_df["Channel_Id"].map(scores).fillna(0.0)
+
+    # Dense rank every criterion (largest value first) into one array, then
+    # average the ranks in a single vectorized pass.
+    rank_columns = ["Videos", "Subscribers", "Score", "Similarity"]
+    values = combined_df[rank_columns].to_numpy(dtype=np.float64)
+    ranks = np.empty((len(rank_columns), len(combined_df)), dtype=np.int64)
+    for i, column in enumerate(rank_columns):
+        _, inverse = np.unique(-values[:, i], return_inverse=True)
+        ranks[i] = inverse + 1
+        combined_df[f"{column}_Rank"] = ranks[i]
+    combined_df["Average_Rank"] = ranks.mean(axis=0)
 
     combined_df = combined_df.sort_values(by="Average_Rank")
 
@@ -527,55 +983,93 @@ def fuzzy_similarity(str1: str, str2: str) -> float:
     int
         A ratio between 0 and 100 representing how similar the match is.
     """
-    str1 = str1.lower()
-    str2 = str2.lower()
-
-    pattern_words = re.findall(r"\w+", str1)
-
-    best_ratio = 0.0
-    for i in range(len(str2)):
-        text_words = re.findall(r"\w+", str2[i:])
-        if len(text_words) < len(pattern_words):
-            break
-        ratios = [
-            fuzz.ratio(w, text_words[j]) for j, w in enumerate(pattern_words)
-        ]
-        avg_ratio = sum(ratios) / len(ratios)
-        if avg_ratio > best_ratio:
-            best_ratio = avg_ratio
+    return float(fuzzy_similarities(str1, [str2])[0])
 
-    return best_ratio
 
-
-def get_services(query: str) -> Dict[str, Any]:
+def fuzzy_similarities(query: str, texts: List[str]) -> np.ndarray:
     """
-    Method used to pass global data and services into graph.
+    Find the similarity between the query and a match in each of the texts.
+
+    Each text is scored by the best average fuzzy ratio between the query
+    words and a run of consecutive words in the text. The words of every
+    text are scored against the query in one batch, so a request makes two
+    cdist calls however many channels it has, and identical texts are only
+    scored once.
 
     Parameters
     ----------
     query : str
-        The query string that is mapped to a q value in the youtube api call.
+        This is the query string.
+    texts : list[str]
+        The descriptions of the channels.
 
     Returns
     -------
-    dict[str, Any]
-        Returns a dictionary of services for a graph.
+    np.ndarray
+        One ratio between 0 and 100 per text, in the same order as texts.
     """
-    return {"query": query}
+    pattern_words = WORD_PATTERN.findall(query.lower())
+    n_pattern = len(pattern_words)
+    unique_texts = list(dict.fromkeys(texts))
+    scores = np.zeros(len(unique_texts), dtype=np.float64)
+
+    # Texts with fewer words than the query score 0, and the pattern words
+    # appearing consecutively is a perfect match, which is common when the
+    # query is a channel's name.
+    pattern = f" {' '.join(pattern_words)} "
+    candidates: List[int] = []
+    text_words: List[List[str]] = []
+    for i, text in enumerate(unique_texts):
+        words = WORD_PATTERN.findall(text.lower())
+        if not pattern_words or len(words) < n_pattern:
+            continue
+        if pattern in f" {' '.join(words)} ":
+            scores[i] = 100.0
+            continue
+        candidates.append(i)
+        text_words.append(words)
+
+    if candidates:
+        # Lay the words of every candidate end to end. Window k of a text
+        # covers its words k .. k + n_pattern - 1, so its first word sits at
+        # a global position in `starts`.
+        lengths = np.array([len(words) for words in text_words])
+        n_windows = lengths - n_pattern + 1
+        text_starts = np.cumsum(lengths) - lengths
+        window_offsets = np.cumsum(n_windows) - n_windows
+        starts = np.repeat(text_starts - window_offsets, n_windows) + np.arange(
+            n_windows.sum()
+        )
+        all_words = [word for words in text_words for word in words]
+
+        # A match may start part way through a word, so the first pattern
+        # word is scored against every suffix of each window's first word.
+        first_words = [all_words[k] for k in starts]
+        suffixes = [word[j:] for word in first_words for j in range(len(word))]
+        suffix_offsets = np.cumsum([0] + [len(word) for word in first_words])
+        suffix_ratios = process.cdist(
+            pattern_words[:1], suffixes, scorer=fuzz.ratio, workers=-1
+        )
+        # Ratios are rounded with np.rint (half to even) to keep the integer
+        # ratios fuzzywuzzy used to return. cdist's integer dtypes round
+        # halves up instead, which would change the scores.
+        window_sums = np.maximum.reduceat(
+            np.rint(suffix_ratios[0]), suffix_offsets[:-1]
+        )
 
+        # Score the remaining pattern words against every text word in one
+        # call, then add each pattern word's ratio at its place in a window.
+        ratios = process.cdist(
+            pattern_words[1:], all_words, scorer=fuzz.ratio, workers=-1
+        )
+        for j, row in enumerate(np.rint(ratios), 1):
+            window_sums += row[starts + j]
 
-def store_results(key: ChainType, df: pd.DataFrame):
-    """
-    Store transform results for final processing.
+        best = np.maximum.reduceat(window_sums, window_offsets)
+        scores[candidates] = best.astype(np.float64) / n_pattern
 
-    Parameters
-    ----------
-    key : str
-        The type of data (channel_data or comment_thread_data)
-    df : pd.DataFrame
-        The dataframe output by the transform function.
-    """
-    KV_STORE[key] = df
+    index = {text: i for i, text in enumerate(unique_texts)}
+    return scores[[index[text] for text in texts]]
 
 
 def main(query: str):
@@ -592,29 +1086,21 @@ def main(query: str):
     # *DO NOT* leave this option enabled in production.
     os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 
-    # Download NLTK plug-ins
-    download()
-
-    # Create the Bonobo graph
-    graph = bonobo.Graph()
-    graph.add_chain(extract_search_data)
-    graph.add_chain(store_results, _input=None)
-    graph.add_chain(
-        extract_channel_data,
-        transform_channel_data,
-        store_results,
-        _input=extract_search_data,
-    )
-    graph.add_chain(
-        extract_comment_thread_data,
-        transform_comment_thread_data,
-        store_results,
-        _input=extract_search_data,
-    )
-    bonobo.run(graph, services=get_services(query))
+    videos = index_search_data(extract_search_data(query))
+
+    # The channel and comment thread data only depend on the search results,
+    # so fetch them concurrently. The channels are transformed while the
+    # comments are still being fetched.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        comment_future = executor.submit(extract_comment_thread_data, videos)
+        channel_future = executor.submit(extract_channel_data, videos)
+        channel_df = transform_channel_data(channel_future.result(), query)
+        comment_thread_df = transform_comment_thread_data(
+            comment_future.result()
+        )
 
-    # Combine results of both chains in the graph.
-    df = transform_data()
+    # Combine the results of both.
+    df = transform_data(channel_df, comment_thread_df)
     return df
 
 
@@ -631,5 +1117,8 @@ if __name__ == "__main__":
     # 3. Parse the arguments
     args = parser.parse_args()
 
-    # 4. Invoke main method
+    # 4. Download NLTK plug-ins
+    download()
+
+    # 5. Invoke main method
     main(args.q)
@@ -0,0 +1,24 @@
+"""
+Test the download module
+"""
+
+from unittest.mock import MagicMock, patch
+
+from backend.src.download import download
+
+
+@patch("nltk.download")
+@patch("nltk.data.find")
+def test_download(mock_find: MagicMock, mock_download: MagicMock):
+    """
+    Test the download method only downloads missing packages.
+    """
+
+    def find(path: str):
+        if path == "corpora/wordnet":
+            raise LookupError(path)
+        return path
+
+    mock_find.side_effect = find
+    download()
+    mock_download.assert_called_once_with("wordnet", quiet=True)
@@ -0,0 +1,64 @@
+"""
+Test the response_cache module
+"""
+
+import os
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from backend.src.response_cache import cache_path, load_response, save_response
+
+
+def make_request(uri: str) -> MagicMock:
+    """
+    Make a fake API request for a uri.
+    """
+    request = MagicMock()
+    request.method = "GET"
+    request.uri = uri
+    request.body = None
+    return request
+
+
+def test_cache_disabled():
+    """
+    Test nothing is cached when no cache directory is set.
+    """
+    request = make_request("https://example.com/search?q=dodgers")
+    with patch("backend.src.response_cache.CACHE_DIR", None):
+        assert cache_path(request) is None
+        save_response(request, {"items": []})
+        assert load_response(request) is None
+
+
+def test_save_and_load_response(tmp_path: Path):
+    """
+    Test a saved response is loaded until it expires.
+    """
+    request = make_request("https://example.com/search?q=dodgers")
+    other_request = make_request("https://example.com/search?q=angels")
+    response = {"items": [{"id": "video1"}]}
+    with patch("backend.src.response_cache.CACHE_DIR", str(tmp_path)):
+        assert load_response(request) is None
+        save_response(request, response)
+        assert load_response(request) == response
+        assert load_response(other_request) is None
+
+        path = str(cache_path(request))
+        stale = os.path.getmtime(path) - 2
+        os.utime(path, (stale, stale))
+        with patch("backend.src.response_cache.CACHE_TTL", 1):
+            assert load_response(request) is None
+
+
+def test_save_response_failure(tmp_path: Path):
+    """
+    Test a response that cannot be written is skipped without leaving files.
+    """
+    request = make_request("https://example.com/search?q=dodgers")
+    with patch("backend.src.response_cache.CACHE_DIR", str(tmp_path)), patch(
+        "backend.src.response_cache.os.replace", side_effect=OSError
+    ):
+        save_response(request, {"items": []})
+        assert load_response(request) is None
+    assert os.listdir(tmp_path) == []
@@ -2,96 +2,262 @@
 Test the youtube_scrape module
 """
 
+import asyncio
 import json
-import re
-from typing import Optional
+from pathlib import Path
+from typing import Any, Optional, Tuple
 from unittest.mock import MagicMock, patch
 
+import pandas as pd
+import pytest
+from googleapiclient.errors import HttpError
+
 from backend.src.youtube_scrape import (
-    ChainType,
+    NUM_RETRIES,
+    SENTIMENT_SCORES,
+    THREAD_DATA,
+    USER_AGENT,
+    Query,
+    RateLimiter,
+    Row,
+    SentimentMethod,
+    do_query,
+    execute_batch,
+    execute_request,
     extract_channel_data,
     extract_comment_thread_data,
     extract_search_data,
+    fuzzy_similarities,
     fuzzy_similarity,
+    index_search_data,
+    init_worker,
+    is_retryable,
+    lifespan,
     main,
+    perform_batch_sentiment_analysis,
+    perform_lexicon_sentiment_analysis,
     perform_sentiment_analysis,
+    sample_videos,
+    sentiment_pool,
     transform_channel_data,
     transform_comment_thread_data,
     transform_data,
 )
 
+# The JSON fixtures are read once for the whole module and must not be
+# modified by the tests.
+TEST_DIR = Path(__file__).parent
+_SEARCH_DATA = json.loads((TEST_DIR / "search_results.json").read_bytes())
+_CHANNEL_DATA = json.loads((TEST_DIR / "channel_results.json").read_bytes())
+_COMMENT_THREAD_DATA = json.loads(
+    (TEST_DIR / "comment_thread_results.json").read_bytes()
+)
+_SEARCH_RESULTS = [
+    (
+        item.get("id", {}).get("videoId"),
+        item.get("snippet", {}).get("channelId"),
+    )
+    for list_item in _SEARCH_DATA
+    for item in list_item.get("items", [])
+]  # What extract_search_data returns for the search fixture
+_VIDEO_IDS = {video_id for video_id, _ in _SEARCH_RESULTS}
+YOUTUBE_URL_PREFIX = "https://www.youtube.com/"
+
 
-def test_fuzzy_similarity():
+class _Stub:
     """
-    Test the fuzzy_similarity method.
+    Stand-in for an API request that returns a canned response.
     """
 
-    str1 = "Dodgers"
-    str2 = "dodgers"
-    result = fuzzy_similarity(str1, str2)
-    assert result == 100.0
+    __slots__ = ("_response",)
 
-    result = fuzzy_similarity(str1, "")
-    assert result == 0.0
+    def __init__(self, response: Any):
+        self._response = response
 
-    result = fuzzy_similarity(str1, "Dodge ball")
-    assert result == 83.0
+    def execute(self, **kwargs) -> Any:
+        """
+        Return the canned response, ignoring the execution options.
+        """
+        return self._response
 
-    str2 = (
-        "DodgerBlue.com is run by credentialed reporters and your "
-        + "trusted source for the latest Los Angeles Dodgers news, rumors, "
-        + "opinion, score updates and more involving Shohei Ohtani, Mookie"
-        + " Betts, Freddie Freeman"
-    )
-    result = fuzzy_similarity(str1, str2)
-    assert result == 100.0
-
-    str2 = (
-        "Looking over the country with those sunken eyes as if the world"
-        + " out there had been altered or made suspect by what he’d seen of it "
-        + "elsewhere. As if he might never see it right again. Or worse did "
-        + "see it right at last. See it as it had always been, would "
-        "forever be."
-    )
-    result = fuzzy_similarity(str1, str2)
-    assert result == 55.0
 
+DODGER_BLUE = (
+    "DodgerBlue.com is run by credentialed reporters and your "
+    + "trusted source for the latest Los Angeles Dodgers news, rumors, "
+    + "opinion, score updates and more involving Shohei Ohtani, Mookie"
+    + " Betts, Freddie Freeman"
+)
+SUNKEN_EYES = (
+    "Looking over the country with those sunken eyes as if the world"
+    + " out there had been altered or made suspect by what he’d seen of it "
+    + "elsewhere. As if he might never see it right again. Or worse did "
+    + "see it right at last. See it as it had always been, would "
+    + "forever be."
+)
+TOUCH_OF_GREY = (
+    "The shoe is on the hand it fits, there's really nothing much to it "
+    + "Whistle through your teeth and spit 'cause it's alright "
+    + "Oh, well, a touch of grey, kinda suits you anyway "
+    + "That was all I had to say and it's alright"
+)
 
-def test_perform_sentiment_analysis():
+
+@pytest.mark.parametrize(
+    "str2, expected",
+    [
+        ("dodgers", 100.0),
+        ("", 0.0),
+        ("Dodge ball", 83.0),
+        (DODGER_BLUE, 100.0),
+        (SUNKEN_EYES, 55.0),
+    ],
+)
+def test_fuzzy_similarity(str2: str, expected: float):
+    """
+    Test the fuzzy_similarity method.
+    """
+    assert fuzzy_similarity("Dodgers", str2) == expected
+
+
+def test_fuzzy_similarities():
+    """
+    Test the fuzzy_similarities method.
+    """
+
+    texts = ["dodgers", "", "Dodge ball", "dodgers"]
+    result = fuzzy_similarities("Dodgers", texts)
+    assert result.tolist() == [100.0, 0.0, 83.0, 100.0]
+    assert result.tolist() == [fuzzy_similarity("Dodgers", t) for t in texts]
+    assert fuzzy_similarities("Dodgers", []).tolist() == []
+    assert fuzzy_similarities("", texts).tolist() == [0.0] * len(texts)
+
+    with patch("backend.src.youtube_scrape.process.cdist") as mock_cdist:
+        result = fuzzy_similarities("LA Dodgers", ["The LA Dodgers fan club"])
+    assert result.tolist() == [100.0]
+    mock_cdist.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        (SUNKEN_EYES, 0.0),
+        ("Good!, Great!, Fantastic!", 0.691),
+        ("Terrible!, Horrible!, Sucks!", 0.0),
+        (TOUCH_OF_GREY, 0.226),
+    ],
+)
+def test_perform_sentiment_analysis(text: str, expected: float):
     """
     Test the perform_sentiment_analysis method.
     """
+    assert perform_sentiment_analysis(text) == expected
 
-    str1 = (
-        "Looking over the country with those sunken eyes as if the world"
-        + " out there had been altered or made suspect by what he’d seen of it "
-        + "elsewhere. As if he might never see it right again. Or worse "
-        + "did see it right at last. See it as it had always been, would "
-        + "forever be."
-    )
-    result = perform_sentiment_analysis(str1)
-    assert result == 0.0
-
-    str1 = "Good!, Great!, Fantastic!"
-    result = perform_sentiment_analysis(str1)
-    assert result == 0.691
-
-    str1 = "Terrible!, Horrible!, Sucks!"
-    result = perform_sentiment_analysis(str1)
-    assert result == 0.0
-
-    str1 = (
-        "The shoe is on the hand it fits, there's really nothing much to it "
-        + "Whistle through your teeth and spit 'cause it's alright "
-        + "Oh, well, a touch of grey, kinda suits you anyway "
-        + "That was all I had to say and it's alright"
+
+def test_perform_sentiment_analysis_cache():
+    """
+    Test repeated comments are scored from the cache.
+    """
+    perform_sentiment_analysis(TOUCH_OF_GREY)
+    hits = perform_sentiment_analysis.cache_info().hits
+    assert perform_sentiment_analysis(TOUCH_OF_GREY) == 0.226
+    assert perform_sentiment_analysis.cache_info().hits == hits + 1
+
+
+def test_perform_sentiment_analysis_repeated_symbols():
+    """
+    Test long runs of a repeated symbol score the same as a run of four.
+    """
+    spam = perform_sentiment_analysis("Love it " + "\U0001F60D" * 5000)
+    assert spam == perform_sentiment_analysis("Love it " + "\U0001F60D" * 4)
+
+
+def test_perform_batch_sentiment_analysis():
+    """
+    Test the perform_batch_sentiment_analysis method.
+    """
+
+    result = perform_batch_sentiment_analysis(
+        [
+            SUNKEN_EYES,
+            "Good!, Great!, Fantastic!",
+            "Terrible!, Horrible!, Sucks!",
+            TOUCH_OF_GREY,
+        ]
     )
-    result = perform_sentiment_analysis(str1)
-    assert result == 0.226
+    assert result == [0.0, 0.691, 0.0, 0.226]
+
+    texts = [
+        "Good!, Great!, Fantastic!",
+        "Terrible!, Horrible!, Sucks!",
+        "",
+    ]
+    result = perform_batch_sentiment_analysis(texts)
+    assert result == [perform_sentiment_analysis(text) for text in texts]
+    assert perform_batch_sentiment_analysis([]) == []
+
+    with patch(
+        "backend.src.youtube_scrape.SENTIMENT_METHOD", SentimentMethod.LEXICON
+    ):
+        result = perform_batch_sentiment_analysis(texts)
+    assert result == perform_lexicon_sentiment_analysis(texts)
+
+
+def test_perform_batch_sentiment_analysis_pool():
+    """
+    Test large batches are scored by the worker processes once.
+    """
+    texts = [
+        "Pooled: Good!, Great!, Fantastic!",
+        "Pooled: Terrible!, Horrible!, Sucks!",
+    ]
+    expected = [perform_sentiment_analysis(text) for text in texts]
+    with patch("backend.src.youtube_scrape.SENTIMENT_WORKERS", 2), patch(
+        "backend.src.youtube_scrape.SENTIMENT_POOL_THRESHOLD", 1
+    ):
+        try:
+            assert perform_batch_sentiment_analysis(texts * 2) == expected * 2
+        finally:
+            sentiment_pool().shutdown()
+            sentiment_pool.cache_clear()
+        assert set(texts) <= SENTIMENT_SCORES.keys()
+
+        with patch("backend.src.youtube_scrape.sentiment_pool") as mock_pool:
+            assert perform_batch_sentiment_analysis(texts) == expected
+        mock_pool.assert_not_called()
+
+
+def test_perform_lexicon_sentiment_analysis():
+    """
+    Test the perform_lexicon_sentiment_analysis method.
+    """
+
+    texts = [
+        "Good!, Great!, Fantastic!",
+        "Terrible!, Horrible!, Sucks!",
+        "Good seats, bad game",
+        "",
+    ]
+    result = perform_lexicon_sentiment_analysis(texts)
+    assert result == [1.0, 0.0, 0.25, 0.0]
+
+
+@pytest.fixture(scope="module")
+def channel_df() -> pd.DataFrame:
+    """
+    The channel fixture transformed for the query "dodgers".
+    """
+    return transform_channel_data(_CHANNEL_DATA, "dodgers")
 
 
-@patch("bonobo.config.use")
-def test_transform_channel_data(use_mock: MagicMock):
+@pytest.fixture(scope="module")
+def comment_thread_df() -> pd.DataFrame:
+    """
+    The comment thread fixture transformed into channel scores.
+    """
+    return transform_comment_thread_data(_COMMENT_THREAD_DATA)
+
+
+def test_transform_channel_data(channel_df: pd.DataFrame):
     """
     Test the transform_channel_data method.
     """
@@ -105,29 +271,14 @@ def test_transform_channel_data(use_mock: MagicMock):
         "Similarity",
     ]
 
-    use_mock.return_value = None
-    with open("backend/tests/channel_results.json", "r") as json_file:
-        channel_data = json.load(json_file)
-    key, df = next(transform_channel_data(channel_data, "dodgers"))
-    assert key == ChainType.CHANNEL_DATA
+    df = channel_df
     assert df.columns.to_list() == columns
     assert len(df) == 30
-    assert all(
-        [
-            similarity >= 0.0 and similarity <= 100.0
-            for similarity in df["Similarity"].to_list()
-        ]
-    )
-    assert all(
-        [
-            re.match("https://www.youtube.com/.*", url)
-            for url in df["Url"].to_list()
-        ]
-    )
+    assert df["Similarity"].between(0.0, 100.0).all()
+    assert df["Url"].str.startswith(YOUTUBE_URL_PREFIX).all()
 
 
-@patch("bonobo.config.use")
-def test_transform_comment_thread_data(use_mock: MagicMock):
+def test_transform_comment_thread_data(comment_thread_df: pd.DataFrame):
     """
     Test the transform_comment_thread_data method.
     """
@@ -135,20 +286,45 @@ def test_transform_comment_thread_data(use_mock: MagicMock):
         "Channel_Id",
         "Score",
     ]
-    use_mock.return_value = None
-    with open("backend/tests/comment_thread_results.json", "r") as json_file:
-        comment_threads_data = json.load(json_file)
-    key, df = next(transform_comment_thread_data(comment_threads_data))
-    assert key == ChainType.COMMENT_THREAD_DATA
+    df = comment_thread_df
     assert df.columns.to_list() == columns
     assert len(df) == 3
-    assert all(
-        [score >= 0.0 and score <= 1.0 for score in df["Score"].to_list()]
-    )
+    assert df["Score"].between(0.0, 1.0).all()
+
+
+def test_transform_comment_thread_data_missing_channel():
+    """
+    Test comments without a channel id are left out of the averages.
+    """
+
+    def thread(channel_id: Optional[str], text: str) -> dict:
+        snippet = {"textOriginal": text}
+        return {
+            "snippet": {
+                "channelId": channel_id,
+                "topLevelComment": {"snippet": snippet},
+            }
+        }
+
+    comment_thread_data = {
+        "items": [
+            {
+                "items": [
+                    thread("channel1", "Good!, Great!, Fantastic!"),
+                    thread(None, "Good!, Great!, Fantastic!"),
+                    thread("channel1", "Terrible!, Horrible!, Sucks!"),
+                ]
+            }
+        ]
+    }
+    df = transform_comment_thread_data(comment_thread_data)
+    assert df["Channel_Id"].to_list() == ["channel1"]
+    assert df["Score"].to_list() == [0.691 / 2]
 
 
-@patch("bonobo.config.use")
-def test_transform_data(use_mock: MagicMock):
+def test_transform_data(
+    channel_df: pd.DataFrame, comment_thread_df: pd.DataFrame
+):
     """
     Test the transform_data method.
     """
@@ -167,54 +343,88 @@ def test_transform_data(use_mock: MagicMock):
         "Similarity_Rank",
         "Average_Rank",
     ]
-    use_mock.return_value = None
 
-    with open("backend/tests/comment_thread_results.json", "r") as json_file:
-        comment_thread_data = json.load(json_file)
+    df = transform_data(channel_df, comment_thread_df)
 
-    with open("backend/tests/channel_results.json", "r") as json_file:
-        channel_data = json.load(json_file)
+    assert len(df) == 30
+    assert df["Score"].between(0.0, 1.0).all()
 
-    _, comment_thread_df = next(
-        transform_comment_thread_data(comment_thread_data)
-    )
-    _, channel_data_df = next(transform_channel_data(channel_data, "dodgers"))
+    assert df["Similarity"].between(0.0, 100.0).all()
 
-    kv_store_mock = {
-        ChainType.CHANNEL_DATA: channel_data_df,
-        ChainType.COMMENT_THREAD_DATA: comment_thread_df,
-    }
-    with patch("backend.src.youtube_scrape.KV_STORE", kv_store_mock):
-        df = transform_data()
+    assert df["Videos_Rank"].between(1, len(df)).all()
 
-    assert len(df) == 30
-    assert all(
-        [score >= 0.0 and score <= 1.0 for score in df["Score"].to_list()]
-    )
+    assert df["Subscribers_Rank"].between(1, len(df)).all()
 
-    assert all(
-        [
-            similarity >= 0.0 and similarity <= 100.0
-            for similarity in df["Similarity"].to_list()
-        ]
-    )
+    assert df["Score_Rank"].between(1, len(df)).all()
 
-    assert all(
-        [rank > 0 and rank <= len(df) for rank in df["Videos_Rank"].to_list()]
-    )
+    assert df.columns.to_list() == columns
 
-    assert all(
-        [
-            rank > 0 and rank <= len(df)
-            for rank in df["Subscribers_Rank"].to_list()
+
+def test_transform_data_ranks_counts_numerically():
+    """
+    Test counts from the API, which are strings, are ranked as numbers.
+    """
+    channel_data = {
+        "items": [
+            {
+                "id": "small",
+                "snippet": {"title": "Small", "customUrl": "@small"},
+                "statistics": {"videoCount": "9", "subscriberCount": "1000"},
+            },
+            {
+                "id": "large",
+                "snippet": {"title": "Large", "customUrl": "@large"},
+                "statistics": {"videoCount": "1000"},
+            },
         ]
-    )
+    }
+    channel_df = transform_channel_data(channel_data, "dodgers")
+    assert channel_df["Videos"].dtype == "int64"
+    assert channel_df["Subscribers"].dtype == "int64"
+    assert channel_df["Subscribers"].to_list() == [1000, 0]
 
-    assert all(
-        [rank > 0 and rank <= len(df) for rank in df["Score_Rank"].to_list()]
-    )
+    comment_thread_df = pd.DataFrame({"Channel_Id": ["small"], "Score": [0.5]})
+    df = transform_data(channel_df, comment_thread_df).set_index("Channel_Id")
 
-    assert df.columns.to_list() == columns
+    assert df.loc["large", "Videos_Rank"] == 1
+    assert df.loc["small", "Videos_Rank"] == 2
+    assert df.loc["small", "Subscribers_Rank"] == 1
+    assert df.loc["large", "Score"] == 0.0
+
+
+def test_index_search_data():
+    """
+    Tests the index_search_data method.
+    """
+    search_data = [
+        ("video_1", "channel_1"),
+        ("video_2", "channel_2"),
+        ("video_3", "channel_1"),
+    ]
+    videos = index_search_data(search_data)
+    assert videos == {
+        "channel_1": ["video_1", "video_3"],
+        "channel_2": ["video_2"],
+    }
+    assert list(videos) == ["channel_1", "channel_2"]
+
+
+def test_sample_videos():
+    """
+    Tests the sample_videos method.
+    """
+    videos = {
+        "channel_1": ["video_1", "video_2", "video_3", "video_4"],
+        "channel_2": ["video_5"],
+        "channel_3": ["video_6", "video_7"],
+    }
+    result = sample_videos(videos, 2)
+    assert len(result) == 5
+    assert len(set(result)) == 5
+    assert set(result[:2]) <= set(videos["channel_1"])
+    assert result[2] == "video_5"
+    assert set(result[3:]) == set(videos["channel_3"])
+    assert sample_videos({}, 2) == []
 
 
 @patch("googleapiclient.discovery.build")
@@ -223,104 +433,221 @@ def test_extract_comment_thread_data(mock_googleapi: MagicMock):
     Tests the extract_comment_thread_data method.
     """
 
-    def list_method(part: Optional[str], videoId: Optional[str]):
-        video_id = str(videoId)
-        assert part == "id, replies, snippet"
-        retval = MagicMock()
-        retval.execute.return_value = {"videoId": video_id}
-        return retval
+    def list_method(
+        part: Optional[str],
+        videoId: Optional[str],
+        maxResults: int,
+        order: str,
+    ):
+        assert part == "snippet"
+        assert maxResults == 20
+        assert order == "relevance"
+        return _Stub({"videoId": videoId})
+
+    def new_batch_http_request(callback):
+        requests = []
+        batch = MagicMock()
+        batch.add.side_effect = lambda request, request_id: requests.append(
+            (request_id, request)
+        )
+        batch.execute.side_effect = lambda http: [
+            callback(request_id, request.execute(), None)
+            for request_id, request in requests
+        ]
+        return batch
 
     instance = MagicMock()
     comment_threads = MagicMock()
     comment_threads.list.side_effect = list_method
     instance.commentThreads.return_value = comment_threads
+    instance.new_batch_http_request.side_effect = new_batch_http_request
     mock_googleapi.return_value = instance
 
-    with open("backend/tests/search_results.json", "r") as json_file:
-        search_data = json.load(json_file)
-
-    search_data_results = []
-    for list_item in search_data:
-        for item in list_item.get("items", []):
-            video_id = item.get("id", {}).get("videoId")
-            channel_id = item.get("snippet", {}).get("channelId")
-            search_data_results.append((video_id, channel_id))
-
-    comment_thread_data = next(extract_comment_thread_data(search_data_results))
+    videos = index_search_data(_SEARCH_RESULTS)
+    comment_thread_data = extract_comment_thread_data(videos)
     assert comment_threads.list.call_count == 23
-
-    search_data_l = []
-    for list_item in search_data:
-        for item in list_item.get("items", []):
-            video_id = item.get("id", {}).get("videoId")
-            search_data_l.append(video_id)
-
-    for list_item in comment_thread_data.get("items", []):
-        for video_id in [
-            item["videoId"] for item in list_item.get("items", [])
-        ]:
-            assert video_id in search_data_l
+    assert instance.new_batch_http_request.call_count == 1
+    assert len(comment_thread_data.get("items", [])) == 23
+
+    # The fake responses echo the video id they were requested for.
+    for response in comment_thread_data.get("items", []):
+        assert response["videoId"] in _VIDEO_IDS
+
+
+@pytest.mark.parametrize(
+    "status, content, expected",
+    [
+        (429, b"", True),
+        (503, b"", True),
+        (
+            403,
+            b'{"error": {"message": "", "errors": '
+            b'[{"reason": "rateLimitExceeded"}]}}',
+            True,
+        ),
+        (
+            403,
+            b'{"error": {"message": "", "errors": '
+            b'[{"reason": "commentsDisabled"}]}}',
+            False,
+        ),
+        (
+            403,
+            b'{"error": {"message": "", "errors": '
+            b'[{"reason": "rateLimitExceeded"}], "details": '
+            b'[{"@type": "type.googleapis.com/google.rpc.ErrorInfo", '
+            b'"reason": "RATE_LIMIT_EXCEEDED"}]}}',
+            True,
+        ),
+        (403, b"Forbidden", False),
+        (404, b"", False),
+    ],
+)
+def test_is_retryable(status: int, content: bytes, expected: bool):
+    """
+    Tests the is_retryable method.
+    """
+    assert (
+        is_retryable(HttpError(MagicMock(status=status), content)) is expected
+    )
+    assert not is_retryable(ValueError())
 
 
+@patch("backend.src.youtube_scrape.time.sleep")
 @patch("googleapiclient.discovery.build")
-def test_extract_channel_data(mock_googleapi: MagicMock):
+def test_extract_comment_thread_data_retry(
+    mock_googleapi: MagicMock, mock_sleep: MagicMock
+):
     """
-    Tests the extract_channel_data method.
+    Tests rate limited requests and batches are sent again in a new batch.
     """
+    batch_failures = [HttpError(MagicMock(status=503), b"")]
+    failures = {"video1": 2, "video2": 0, "video3": NUM_RETRIES + 1}
+
+    def new_batch_http_request(callback):
+        requests = []
+        batch = MagicMock()
+        batch.add.side_effect = lambda request, request_id: requests.append(
+            (request_id, request)
+        )
 
-    def list_method(
-        part: Optional[str] = None,
-        id: Optional[str] = None,
-        pageToken: Optional[str] = None,
-        maxResults: int = 5,
-    ):
-        id = str(id)
-        assert part == "id, statistics, snippet"
-        ids = id.split(",")
-        assert len(ids) <= 10
-        retval = MagicMock()
-        retval.id.return_value = {"id": id}
-        retval.execute.return_value = {"items": [{"id": id} for id in ids]}
-        return retval
+        def execute(http):
+            if batch_failures:
+                raise batch_failures.pop()
+            for request_id, request in requests:
+                video_id = request.execute()["videoId"]
+                if failures[video_id]:
+                    failures[video_id] -= 1
+                    error = HttpError(MagicMock(status=429), b"")
+                    callback(request_id, None, error)
+                else:
+                    callback(request_id, {"videoId": video_id}, None)
+
+        batch.execute.side_effect = execute
+        return batch
 
     instance = MagicMock()
-    channels = MagicMock()
-    channels.list.side_effect = list_method
-    instance.channels.return_value = channels
+    instance.commentThreads.return_value.list.side_effect = (
+        lambda videoId, **kwargs: _Stub({"videoId": videoId})
+    )
+    instance.new_batch_http_request.side_effect = new_batch_http_request
     mock_googleapi.return_value = instance
 
-    with open("backend/tests/search_results.json", "r") as json_file:
-        search_data = json.load(json_file)
+    videos = {"channel1": ["video1"], "channel2": ["video2", "video3"]}
+    comment_thread_data = extract_comment_thread_data(videos)
+    assert comment_thread_data["items"] == [
+        {"videoId": "video1"},
+        {"videoId": "video2"},
+    ]
+    assert instance.new_batch_http_request.call_count == NUM_RETRIES + 1
+    assert mock_sleep.call_count == NUM_RETRIES
 
-    search_data_results = []
-    for list_item in search_data:
-        for item in list_item.get("items", []):
-            video_id = item.get("id", {}).get("videoId")
-            channel_id = item.get("snippet", {}).get("channelId")
-            search_data_results.append((video_id, channel_id))
 
-    result = next(extract_channel_data(search_data_results))
-    assert channels.list.call_count == 2
-    assert "items" in result
-    items = result.get("items", [])
-    assert len(items) == 17
-    for item in items:
-        assert "id" in item
+@patch("googleapiclient.http.build_http")
+def test_init_worker(mock_build_http: MagicMock):
+    """
+    Tests the init_worker method.
+    """
+    http = MagicMock()
+    request = http.request
+    request.return_value = (MagicMock(), b"")
+    mock_build_http.return_value = http
+
+    init_worker()
+    THREAD_DATA.http.request("https://www.googleapis.com/batch/youtube/v3")
+    headers = request.call_args.kwargs["headers"]
+    assert headers["user-agent"] == USER_AGENT
+    assert "(gzip)" in USER_AGENT
+
+
+@patch("backend.src.youtube_scrape.RATE_LIMITER")
+@patch("backend.src.youtube_scrape.response_cache")
+def test_execute_request(mock_cache: MagicMock, mock_limiter: MagicMock):
+    """
+    Tests the execute_request method.
+    """
+    request = MagicMock()
+    request.execute.return_value = {"items": []}
+    mock_cache.load_response.return_value = None
+    assert execute_request(request, "search") == {"items": []}
+    mock_limiter.acquire.assert_called_once_with(100)
+    mock_cache.save_response.assert_called_once_with(request, {"items": []})
+
+    # A cached response does not spend quota.
+    request.reset_mock()
+    mock_limiter.reset_mock()
+    mock_cache.load_response.return_value = {"items": [{"id": "cached"}]}
+    assert execute_request(request, "search") == {"items": [{"id": "cached"}]}
+    request.execute.assert_not_called()
+    mock_limiter.acquire.assert_not_called()
+
+
+@patch("backend.src.youtube_scrape.THREAD_DATA")
+def test_execute_batch(mock_thread_data: MagicMock):
+    """
+    Tests the execute_batch method.
+    """
+    batch = MagicMock()
+    with patch("backend.src.youtube_scrape.RATE_LIMITER") as mock_limiter:
+        assert not execute_batch(batch, 50)
+    mock_limiter.acquire.assert_called_once_with(50)
+    batch.execute.assert_called_once_with(http=mock_thread_data.http)
+
+    batch.execute.side_effect = HttpError(MagicMock(status=500), b"")
+    assert execute_batch(batch, 1)
+
+    batch.execute.side_effect = HttpError(MagicMock(status=400), b"")
+    assert not execute_batch(batch, 1)
+
+
+@patch("backend.src.youtube_scrape.time")
+def test_rate_limiter(mock_time: MagicMock):
+    """
+    Tests the RateLimiter class.
+    """
+    mock_time.monotonic.return_value = 0.0
+    limiter = RateLimiter(rate=10, capacity=100)
 
-    search_data_l = []
-    for list_item in search_data:
-        for item in list_item.get("items", []):
-            channel_id = item.get("snippet", {}).get("channelId")
-            search_data_l.append(channel_id)
+    limiter.acquire(100)
+    mock_time.sleep.assert_not_called()
 
-    for list_item in result.get("items", []):
-        list_item.get("id") in search_data_l
+    # The bucket is empty, so each caller waits for its own tokens in turn.
+    limiter.acquire(5)
+    mock_time.sleep.assert_called_with(0.5)
+    limiter.acquire(5)
+    mock_time.sleep.assert_called_with(1.0)
+
+    # Tokens refill with time but never beyond the capacity.
+    mock_time.sleep.reset_mock()
+    mock_time.monotonic.return_value = 100.0
+    limiter.acquire(100)
+    mock_time.sleep.assert_not_called()
 
 
 @patch("googleapiclient.discovery.build")
-def test_extract_channel_data_with_page_token(mock_googleapi: MagicMock):
+def test_extract_channel_data(mock_googleapi: MagicMock):
     """
-    Tests the extract_channel_data method with paging.
+    Tests the extract_channel_data method.
     """
 
     def list_method(
@@ -329,21 +656,11 @@ def test_extract_channel_data_with_page_token(mock_googleapi: MagicMock):
         pageToken: Optional[str] = None,
         maxResults: int = 5,
     ):
-        _ = maxResults
         id = str(id)
         assert part == "id, statistics, snippet"
         ids = id.split(",")
-        assert len(ids) <= 10
-        retval = MagicMock()
-        retval.id.return_value = {"id": id}
-        if not pageToken:
-            retval.execute.return_value = {
-                "nextPageToken": "foobar",
-                "items": [{"id": id} for id in ids],
-            }
-        else:
-            retval.execute.return_value = {"items": [{"id": id} for id in ids]}
-        return retval
+        assert len(ids) <= 50
+        return _Stub({"items": [{"id": id} for id in ids]})
 
     instance = MagicMock()
     channels = MagicMock()
@@ -351,43 +668,40 @@ def test_extract_channel_data_with_page_token(mock_googleapi: MagicMock):
     instance.channels.return_value = channels
     mock_googleapi.return_value = instance
 
-    with open("backend/tests/search_results.json", "r") as json_file:
-        search_data = json.load(json_file)
-
-    search_data_results = []
-    for list_item in search_data:
-        for item in list_item.get("items", []):
-            video_id = item.get("id", {}).get("videoId")
-            channel_id = item.get("snippet", {}).get("channelId")
-            search_data_results.append((video_id, channel_id))
-
-    result = next(extract_channel_data(search_data_results))
-    assert channels.list.call_count == 4
+    videos = index_search_data(_SEARCH_RESULTS)
+    result = extract_channel_data(videos)
+    assert channels.list.call_count == 1
     assert "items" in result
     items = result.get("items", [])
-    assert len(items) == 34
+    assert len(items) == 17
     for item in items:
         assert "id" in item
 
-    search_data_l = []
-    for list_item in search_data:
-        for item in list_item.get("items", []):
-            channel_id = item.get("snippet", {}).get("channelId")
-            search_data_l.append(channel_id)
-
-    for list_item in result.get("items", []):
-        list_item.get("id") in search_data_l
+    channels.list.reset_mock()
+    many_videos = {f"channel{i}": [f"video{i}"] for i in range(120)}
+    result = extract_channel_data(many_videos)
+    assert channels.list.call_count == 3
+    assert [item["id"] for item in result["items"]] == list(many_videos)
 
 
 @patch("googleapiclient.discovery.build")
-@patch("bonobo.config.use")
-def test_extract_search_data_with_page_token(
-    mock_use: MagicMock, mock_googleapi: MagicMock
-):
+def test_extract_search_data_with_page_token(mock_googleapi: MagicMock):
     """
-    Tests the extract_channel_data method with paging.
+    Tests the extract_search_data method with paging.
     """
 
+    # The second page is the first without a nextPageToken, built without
+    # modifying the shared fixture.
+    first_page = _SEARCH_DATA[0]
+    next_page = _Stub(first_page)
+    last_page = _Stub(
+        {
+            key: value
+            for key, value in first_page.items()
+            if key != "nextPageToken"
+        }
+    )
+
     def list_method(
         part: Optional[str] = None,
         q: Optional[str] = None,
@@ -397,132 +711,169 @@ def test_extract_search_data_with_page_token(
     ):
         _ = q
         assert part == "snippet"
-        retval = MagicMock()
-        with open("backend/tests/search_results.json", "r") as json_file:
-            search_data = json.load(json_file)
-        if not pageToken:
-            retval.execute.return_value = search_data[0]
-        else:
-            ret_dict = search_data[0]
-            del ret_dict["nextPageToken"]
-            retval.execute.return_value = ret_dict
-        return retval
-
-    mock_use.return_value = None
+        return next_page if not pageToken else last_page
+
     instance = MagicMock()
     search = MagicMock()
     search.list.side_effect = list_method
     instance.search.return_value = search
     mock_googleapi.return_value = instance
 
-    result = next(extract_search_data("dodgers"))
+    result = extract_search_data("dodgers")
     assert instance.search.call_count == 2
     assert len(result) == 100
 
 
-@patch("backend.src.youtube_scrape.extract_search_data")
-@patch("backend.src.youtube_scrape.extract_channel_data")
-@patch("backend.src.youtube_scrape.extract_comment_thread_data")
-@patch("backend.src.download.download")
-@patch("googleapiclient.discovery.build")
-@patch("bonobo.run")
-@patch("bonobo.Graph")
-def test_main(
-    mock_graph: MagicMock,
-    mock_run: MagicMock,
-    mock_googleapiclient: MagicMock,
-    mock_download: MagicMock,
-    mock_extract_comment_thread_data: MagicMock,
-    mock_extract_channel_data: MagicMock,
-    mock_extract_search_data: MagicMock,
-):
+@patch("backend.src.youtube_scrape.main")
+def test_do_query(mock_main: MagicMock):
     """
-    Test the main method.
-
-    Parameters
-    ----------
-    mock_googleapiclient : MagicMock
-        Mock for googleapi
-    mock_download : MagicMock
-        Mock for NLTK downloads
-    mock_extract_comment_thread_data : MagicMock
-        Mock for comment thread data download
-    mock_extract_channel_data : MagicMock
-        Mock for channel data download
-    mock_extract_search_data : MagicMock
-        Mock for search data download
+    Test the do_query method.
     """
-    columns = [
-        "Channel_Id",
-        "Title",
-        "Url",
-        "Description",
-        "" "Videos",
-        "Subscribers",
-        "Similarity",
-        "Score",
-        "Videos_Rank",
-        "Subscribers_Rank",
-        "Score_Rank",
-        "Similarity_Rank",
-        "Average_Rank",
-    ]
-    with open("backend/tests/search_results.json", "r") as json_file:
-        search_data = json.load(json_file)
-    with open("backend/tests/channel_results.json", "r") as json_file:
-        channel_data = json.load(json_file)
-    with open("backend/tests/comment_thread_results.json", "r") as json_file:
-        comment_thread_data = json.load(json_file)
-
-    mock_extract_comment_thread_data.return_value = comment_thread_data
-    mock_extract_channel_data.return_value = channel_data
-    mock_extract_search_data.return_value = search_data
-    mock_download.return_value = None
-    mock_googleapiclient.return_value = MagicMock()
-    mock_run.return_value = None
-    mock_graph.add_chain.return_value = None
-    _, comment_thread_df = next(
-        transform_comment_thread_data(comment_thread_data)
-    )
-    _, channel_data_df = next(transform_channel_data(channel_data, "dodgers"))
-
-    kv_store_mock = {
-        ChainType.CHANNEL_DATA: channel_data_df,
-        ChainType.COMMENT_THREAD_DATA: comment_thread_df,
+    row = {
+        "Channel_Id": "UC1",
+        "Title": "Dodgers",
+        "Url": "https://www.youtube.com/@dodgers",
+        "Description": "Official channel",
+        "Videos": 10,
+        "Subscribers": 1000,
+        "Similarity": 100.0,
+        "Score": 0.5,
+        "Videos_Rank": 1,
+        "Subscribers_Rank": 1,
+        "Score_Rank": 1,
+        "Similarity_Rank": 1,
+        "Average_Rank": 1.0,
     }
-    with patch("backend.src.youtube_scrape.KV_STORE", kv_store_mock):
+    mock_main.return_value = pd.DataFrame([row] * 25)
+
+    response = asyncio.run(do_query(Query(query_string="dodgers")))
+    mock_main.assert_called_once_with("dodgers")
+    assert response.media_type == "application/json"
+    rows = [Row(**row_dict) for row_dict in json.loads(response.body)]
+    assert rows == [Row(**row)] * 20
+
+
+@patch("backend.src.youtube_scrape.download")
+def test_lifespan(mock_download: MagicMock):
+    """
+    Test that the NLTK plug-ins are downloaded once at startup and the
+    sentiment scoring processes are stopped at shutdown.
+    """
+
+    async def start_and_stop():
+        async with lifespan(MagicMock()):
+            mock_download.assert_called_once_with()
+
+    with patch("backend.src.youtube_scrape.sentiment_pool") as mock_pool:
+        asyncio.run(start_and_stop())
+    mock_download.assert_called_once_with()
+    mock_pool.return_value.shutdown.assert_called_once_with()
+
+
+MAIN_COLUMNS = [
+    "Channel_Id",
+    "Title",
+    "Url",
+    "Description",
+    "Videos",
+    "Subscribers",
+    "Similarity",
+    "Score",
+    "Videos_Rank",
+    "Subscribers_Rank",
+    "Score_Rank",
+    "Similarity_Rank",
+    "Average_Rank",
+]
+
+
+@pytest.fixture(scope="module")
+def main_run() -> Tuple[pd.DataFrame, MagicMock, MagicMock, MagicMock]:
+    """
+    Run main once for the module with the extractors returning the fixtures.
+
+    Returns
+    -------
+    tuple[pd.DataFrame, MagicMock, MagicMock, MagicMock]
+        The result of main, and the mocks for the search, channel and comment
+        thread extractors.
+    """
+    with patch(
+        "backend.src.youtube_scrape.extract_search_data"
+    ) as mock_extract_search_data, patch(
+        "backend.src.youtube_scrape.extract_channel_data"
+    ) as mock_extract_channel_data, patch(
+        "backend.src.youtube_scrape.extract_comment_thread_data"
+    ) as mock_extract_comment_thread_data:
+        mock_extract_search_data.return_value = _SEARCH_RESULTS
+        mock_extract_channel_data.return_value = _CHANNEL_DATA
+        mock_extract_comment_thread_data.return_value = _COMMENT_THREAD_DATA
         df = main("dodgers")
-        assert len(df) == 30
-        assert all(
-            [score >= 0.0 and score <= 1.0 for score in df["Score"].to_list()]
-        )
+    return (
+        df,
+        mock_extract_search_data,
+        mock_extract_channel_data,
+        mock_extract_comment_thread_data,
+    )
 
-        assert all(
-            [
-                similarity >= 0.0 and similarity <= 100.0
-                for similarity in df["Similarity"].to_list()
-            ]
-        )
 
-        assert all(
-            [
-                rank > 0 and rank <= len(df)
-                for rank in df["Videos_Rank"].to_list()
-            ]
-        )
+@pytest.fixture(scope="module")
+def main_df(
+    main_run: Tuple[pd.DataFrame, MagicMock, MagicMock, MagicMock]
+) -> pd.DataFrame:
+    """
+    The result of main for the query "dodgers".
+    """
+    return main_run[0]
 
-        assert all(
-            [
-                rank > 0 and rank <= len(df)
-                for rank in df["Subscribers_Rank"].to_list()
-            ]
-        )
 
-        assert all(
-            [
-                rank > 0 and rank <= len(df)
-                for rank in df["Score_Rank"].to_list()
-            ]
-        )
+def test_main_calls_extractors(
+    main_run: Tuple[pd.DataFrame, MagicMock, MagicMock, MagicMock]
+):
+    """
+    Test main searches once and passes the grouped videos to both
+    extractors.
+    """
+    _, mock_search, mock_channel, mock_comment_thread = main_run
+    mock_search.assert_called_once_with("dodgers")
+    videos = index_search_data(_SEARCH_RESULTS)
+    mock_channel.assert_called_once_with(videos)
+    mock_comment_thread.assert_called_once_with(videos)
+
+
+def test_main_length(main_df: pd.DataFrame):
+    """
+    Test main returns a row per channel.
+    """
+    assert len(main_df) == 30
 
-        assert df.columns.to_list() == columns
+
+def test_main_columns(main_df: pd.DataFrame):
+    """
+    Test main returns the ranked columns.
+    """
+    assert main_df.columns.to_list() == MAIN_COLUMNS
+
+
+@pytest.mark.parametrize(
+    "column, low, high",
+    [("Score", 0.0, 1.0), ("Similarity", 0.0, 100.0)],
+)
+def test_main_value_range(
+    main_df: pd.DataFrame, column: str, low: float, high: float
+):
+    """
+    Test the scores main returns are in range.
+    """
+    assert main_df[column].between(low, high).all()
+
+
+@pytest.mark.parametrize(
+    "column",
+    ["Videos_Rank", "Subscribers_Rank", "Score_Rank", "Similarity_Rank"],
+)
+def test_main_rank_range(main_df: pd.DataFrame, column: str):
+    """
+    Test the ranks main returns are between 1 and the number of rows.
+    """
+    assert main_df[column].between(1, len(main_df)).all()